@@ -6,10 +6,14 @@ Tests `toki.c` against test/tests
 
 
 import argparse
+import hashlib
+import itertools
+import json
 import os
-import shlex
 import subprocess
-from typing import Any
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, BinaryIO, Iterable, Iterator
 
 
 # DEFAULTS
@@ -17,55 +21,100 @@ from typing import Any
 DEFAULT_END_TO_END_PATH = "./test/end_to_end"
 DEFAULT_UNIT_PATH = "./test/unit"
 
+CACHE_PATH = "./.toki_test_cache"
+LAST_PASS_PATH = "./.toki_last_pass"
+
+# How much of an expected output file is compared at a time
+CHUNK_SIZE = 65536
+
 TEST_EXTENSION = "_test.toki"
 EXPECTED_EXTENSION = "_expected.txt"
 
+# Options shared by every test a worker process runs, set by `init_worker`
+_worker_options: "dict[str, Any]" = {}
+
+
+# FLAGS
+
+def positive_int(value: str) -> int:
+    """
+    An argparse `type` for counts that have to be at least 1.
+    """
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {n}")
+    return n
+
+
+# Built once, so calling `get_flags()` again doesn't rebuild it
+_PARSER = argparse.ArgumentParser(
+    prog="toki.c Test Suite",
+    description="Performs all tests located in a given folder and gives "\
+                "back the results.")
+
+_PARSER.add_argument("-a", "--arch",
+                     help="The architecture to test",
+                     choices=["all", "win"],
+                     default="all")
+_PARSER.add_argument("-b", "--batch-size",
+                     help="Compile this many end-to-end tests with each "\
+                          "`toki.exe` invocation.",
+                     metavar="N",
+                     type=positive_int,
+                     default=1)
+_PARSER.add_argument("-c", "--cache",
+                     help="Skip tests that passed last time and are "\
+                          "unchanged, and reuse cached test output. Use "\
+                          "`--no-cache` to run everything (e.g. for CI).",
+                     action=argparse.BooleanOptionalAction,
+                     default=True)
+_PARSER.add_argument("-d", "--default",
+                     help="Use default values for `--endtoend` or `--unit`",
+                     choices=["all", "endtoend", "unit", "none"],
+                     default="none")
+_PARSER.add_argument("-e", "--endtoend",
+                     help="Specify the relative path to the file/folder "\
+                          "for end-to-end tests.",
+                     metavar="PATH",
+                     nargs='*')
+_PARSER.add_argument("--harness",
+                     help="Compile and run end-to-end tests through a "\
+                          "long-lived `toki.exe --harness` process "\
+                          "instead of starting processes for each test.",
+                     action=argparse.BooleanOptionalAction)
+_PARSER.add_argument("-j", "--jobs",
+                     help="How many end-to-end tests (or batches) to run "\
+                          "at once. Defaults to the number of CPUs.",
+                     metavar="N",
+                     type=positive_int,
+                     default=os.cpu_count() or 1)
+_PARSER.add_argument("-m", "--maketoki",
+                     help="Make `toki.c` before running tests if true, or "\
+                          "uses exisiting `toki.exe` if false",
+                     action=argparse.BooleanOptionalAction)
+_PARSER.add_argument("-s", "--showsuccess",
+                     help="Displays all test results, even successes.",
+                     action=argparse.BooleanOptionalAction)
+_PARSER.add_argument("-u", "--unit",
+                     help="Specify the relative path to the file/folder "\
+                          "for unit tests.",
+                     metavar="PATH",
+                     nargs='*')
+
 
 def get_flags() -> "dict[str, Any]":
     """
     Returns the flags necessary for program logic, retrieved from command line
     arguments.
     """
-    parser = argparse.ArgumentParser(
-        prog="toki.c Test Suite",
-        description="Performs all tests located in a given folder and gives "\
-                    "back the results.")
-
-    parser.add_argument("-a", "--arch",
-                        help="The architecture to test",
-                        choices=["all", "win"],
-                        default="all")
-    parser.add_argument("-d", "--default",
-                        help="Use default values for `--endtoend` or `--unit`",
-                        choices=["all", "endtoend", "unit", "none"],
-                        nargs=1,
-                        default="none")
-    parser.add_argument("-e", "--endtoend",
-                        help="Specify the relative path to the file/folder "\
-                             "for end-to-end tests.",
-                        metavar="PATH",
-                        nargs='*')
-    parser.add_argument("-m", "--maketoki",
-                        help="Make `toki.c` before running tests if true, or "\
-                             "uses exisiting `toki.exe` if false",
-                        action=argparse.BooleanOptionalAction)
-    parser.add_argument("-s", "--showsuccess",
-                        help="Displays all test results, even successes.",
-                        action=argparse.BooleanOptionalAction)
-    parser.add_argument("-u", "--unit",
-                        help="Specify the relative path to the file/folder "\
-                             "for unit tests.",
-                        metavar="PATH",
-                        nargs='*')
-
-    args = parser.parse_args().__dict__
-
-    if args["default"] == ["all"]:
+    args = _PARSER.parse_args().__dict__
+
+    if args["default"] == "all":
         args["endtoend"] = [DEFAULT_END_TO_END_PATH]
         args["unit"] = [DEFAULT_UNIT_PATH]
-    elif args["default"] == ["endtoend"]:
+    elif args["default"] == "endtoend":
         args["endtoend"] = [DEFAULT_END_TO_END_PATH]
-    elif args["default"] == ["unit"]:
+    elif args["default"] == "unit":
         args["unit"] = [DEFAULT_UNIT_PATH]
 
     if args["endtoend"]:
@@ -82,27 +131,46 @@ def make_toki():
         raise Exception("Cannot find `toki.c`, try compiling yourself")
     if not os.path.exists("./makefile"):
         raise Exception("Cannot find `makefile`, try compiling yourself")
-    
-    subprocess.run(shlex.split("make toki"))
 
+    # `toki.exe` is already newer than everything it's built from
+    src_mtime = max(os.path.getmtime("./toki.c"),
+                    os.path.getmtime("./makefile"))
+    exe_mtime = (os.path.getmtime("./toki.exe")
+                 if os.path.exists("./toki.exe") else 0)
+    if exe_mtime > src_mtime:
+        return
 
-def test_end_to_end(path: str, print_success: bool) -> tuple[int, int]:
+    subprocess.run(["make", "toki"], check=True)
+
+
+def iter_leaf_tests(path: str) -> Iterator[str]:
+    """
+    Lazily yields every leaf test folder under `path`. A folder containing
+    only folders is walked into, anything else is treated as a single test.
+    """
     if not os.path.isdir(path):
         raise Exception("End-to-end test input needs to be a directory")
-    
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        if filenames:
+            dirnames.clear()
+            yield dirpath
+
+
+def iter_batches(items: "Iterable[str]", size: int) -> "Iterator[list[str]]":
+    it = iter(items)
+    while batch := list(itertools.islice(it, size)):
+        yield batch
+
+
+def find_test_files(path: str) -> tuple[str, str]:
+    """
+    Returns the test file and expected output file of the test in folder
+    `path`, raising if they aren't the only two files there.
+    """
     subfiles = os.listdir(path)
     subpaths = [os.path.join(path, f) for f in subfiles]
 
-    successes = 0
-    trials = 0
-
-    if all(os.path.isdir(f) for f in subpaths):
-        for f in subpaths:
-            s, t = test_end_to_end(f, print_success)
-            successes += s
-            trials += t
-        return successes, trials
-    
     folder = os.path.basename(path)
     test_path = os.path.join(path, folder + TEST_EXTENSION)
     expected_path = os.path.join(path, folder + EXPECTED_EXTENSION)
@@ -113,57 +181,425 @@ def test_end_to_end(path: str, print_success: bool) -> tuple[int, int]:
                         f"`{test_path}` and "
                         f"`{expected_path}`")
 
-    # I can't use fstrings cause I need to replace, and I need to replace
-    # because subprocess is fucking broken on windows. So this looks ugly.
+    return test_path, expected_path
+
+
+def get_cache_path(test_path: str,
+                   toki_hash: "bytes | None") -> "str | None":
+    """
+    Returns where the stdout of `test_path` is cached. The key is `toki_hash`
+    (the hash of `toki.exe`) followed by the hash of the test file, so
+    rebuilding `toki.exe` or editing the test invalidates it. A `toki_hash` of
+    `None` means caching is turned off.
+    """
+    if toki_hash is None:
+        return None
+    with open(test_path, "rb") as tf:
+        key = toki_hash + hashlib.sha256(tf.read()).digest()
+    return os.path.join(CACHE_PATH, key.hex())
+
+
+def read_cache(cache_path: "str | None") -> "bytes | None":
+    if cache_path is None:
+        return None
     try:
-        subprocess.run(
-            shlex.split("./toki.exe %s a" % test_path.replace('\\', '/')),
-            check=True)
-    except subprocess.CalledProcessError as e:
-        newline = '\n'
-        print(f"FAILURE: {path}\n"
-              f"  Compilation error (code: {e.returncode})"
-              f"{newline if e.stderr or e.output else ''}"
-              f"{'  stderr:' + newline + e.stderr if e.stderr else ''}"
-              f"{newline if e.output else ''}"
-              f"{'  output: ' + e.output if e.output else ''}")
-        return (successes, trials + 1)
+        with open(cache_path, "rb") as cf:
+            return cf.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_cache(cache_path: "str | None", stdout: bytes):
+    if cache_path is None:
+        return
+    # Write then rename, so a concurrent reader never sees half a file
+    temp_path = f"{cache_path}.{os.getpid()}"
+    with open(temp_path, "wb") as cf:
+        cf.write(stdout)
+    os.replace(temp_path, cache_path)
+
+
+def format_error(path: str, description: str,
+                 e: subprocess.CalledProcessError) -> str:
+    newline = '\n'
+    return (f"FAILURE: {path}\n"
+            f"  {description} (code: {e.returncode})"
+            f"{newline if e.stderr or e.output else ''}"
+            f"{'  stderr:' + newline + e.stderr if e.stderr else ''}"
+            f"{newline if e.output else ''}"
+            f"{'  output: ' + e.output if e.output else ''}\n")
+
+
+def _rm(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_artifacts(artifact_stem: str):
+    for ext in (".asm", ".obj", ".exe"):
+        _rm(artifact_stem + ext)
+
 
+def normalize_newlines(data: bytes) -> bytes:
+    return data.replace(b"\r\n", b"\n")
+
+
+def read_chunk(file: BinaryIO) -> bytes:
+    """
+    Reads the next `CHUNK_SIZE` bytes of `file` with newlines normalized,
+    making sure a `\r\n` is never split between two chunks.
+    """
+    chunk = file.read(CHUNK_SIZE)
+    if chunk.endswith(b"\r"):
+        chunk += file.read(1)
+    return normalize_newlines(chunk)
+
+
+def run_artifact(path: str,
+                 artifact_stem: str) -> "tuple[bool, bytes | str]":
+    """
+    Runs the executable `toki.exe` produced for the test in folder `path`.
+    Returns whether that succeeded, along with either the program's stdout
+    or a failure message.
+    """
     try:
-        result = subprocess.run(shlex.split("./a.exe"),
-                    capture_output = True,
-                    text = True)
+        result = subprocess.run([f"./{artifact_stem}.exe"],
+                    capture_output = True)
     except subprocess.CalledProcessError as e:
-        newline = '\n'
-        print(f"FAILURE: {path}\n"
-              f"  ASM runtime error (code: {e.returncode})"
-              f"{newline if e.stderr or e.output else ''}"
-              f"{'  stderr:' + newline + e.stderr if e.stderr else ''}"
-              f"{newline if e.output else ''}"
-              f"{'  output: ' + e.output if e.output else ''}")
-        return (successes, trials + 1)
-    
-    if os.path.exists("./a.asm"):
-        os.remove("a.asm")
-    if os.path.exists("./a.obj"):
-        os.remove("a.obj")
-    if os.path.exists("./a.exe"):
-        os.remove("a.exe")
-
-    with open(expected_path) as ef:
-        expected = ef.read()
-        if result.stdout != expected:
-            print(f"FAILURE: {path}\n"
-                  f"  Incorrect output\n"
-                  f"  Got:\n"
-                  f"{result.stdout}\n"
-                  f"  Expected:\n"
-                  f"{expected}")
-            return (successes, trials + 1)
-        if print_success:
-            print(f"SUCCESS: {path}")
-        return (successes + 1, trials + 1)
-        
+        return (False, format_error(path, "ASM runtime error", e))
+    return (True, normalize_newlines(result.stdout))
+
+
+def execute_test(path: str, test_path: str) -> "tuple[bool, bytes | str]":
+    """
+    Compiles `test_path` with `toki.exe` and runs the result. Returns whether
+    that succeeded, along with either the program's stdout or a failure
+    message for the test in folder `path`.
+    """
+    # Every worker gets its own artifacts so that workers running at the same
+    # time don't clobber each other's `a.exe`. A worker runs one test at a
+    # time, so the pid is enough; the folder name is left out since `toki.c`
+    # builds its commands in fixed 80 byte buffers and doesn't quote them.
+    artifact_stem = f"a_{os.getpid()}"
+
+    try:
+        # subprocess quotes list arguments itself, so Windows paths can be
+        # passed as they are
+        try:
+            subprocess.run(["./toki.exe", test_path, artifact_stem],
+                           check=True)
+        except subprocess.CalledProcessError as e:
+            return (False, format_error(path, "Compilation error", e))
+
+        return run_artifact(path, artifact_stem)
+    finally:
+        remove_artifacts(artifact_stem)
+
+
+def check_output(path: str, expected_path: str, stdout: bytes,
+                 print_success: bool) -> tuple[int, int, str]:
+    """
+    Compares `stdout` against the contents of `expected_path`, returning the
+    number of successes, the number of trials, and the message to print.
+    The file is read a chunk at a time and the comparison stops at the first
+    chunk that differs.
+    """
+    # Normalizing newlines only ever shrinks the file, so if it's already
+    # shorter than the output they can't match
+    matches = os.path.getsize(expected_path) >= len(stdout)
+
+    if matches:
+        with open(expected_path, "rb") as ef:
+            offset = 0
+            while chunk := read_chunk(ef):
+                if stdout[offset:offset + len(chunk)] != chunk:
+                    matches = False
+                    break
+                offset += len(chunk)
+            else:
+                matches = offset == len(stdout)
+
+    if not matches:
+        with open(expected_path, "rb") as ef:
+            expected = normalize_newlines(ef.read())
+        return (0, 1,
+                f"FAILURE: {path}\n"
+                f"  Incorrect output\n"
+                f"  Got:\n"
+                f"{stdout.decode('utf-8', errors='replace')}\n"
+                f"  Expected:\n"
+                f"{expected.decode('utf-8', errors='replace')}\n")
+    return (1, 1, f"SUCCESS: {path}\n" if print_success else "")
+
+
+def init_worker(options: "dict[str, Any]"):
+    """
+    Sets the options shared by every test a worker process runs, so they are
+    sent once per worker instead of once per test.
+    """
+    _worker_options.update(options)
+
+
+def is_unchanged(path: str, pass_key: "list[float]") -> bool:
+    # Nothing the test depends on has changed since it last passed
+    return _worker_options["last_pass"].get(path) == pass_key
+
+
+def get_pass_key(test_path: str, expected_path: str) -> "list[float]":
+    """
+    Returns what `LAST_PASS_PATH` records for a passing test: the
+    modification times of `toki.exe`, its expected output, and its test file.
+    """
+    return [_worker_options["toki_mtime"],
+            os.path.getmtime(expected_path),
+            os.path.getmtime(test_path)]
+
+
+def run_one_test(path: str) -> "tuple[int, int, str, dict[str, Any]]":
+    """
+    Runs the single end-to-end test in folder `path`. Returns the number of
+    successes, the number of trials, the output that would have been
+    printed, and what to record in `LAST_PASS_PATH` for the test (its pass
+    key, or `None` if it failed), so that it can be run from a worker process.
+    """
+    print_success = _worker_options["print_success"]
+    test_path, expected_path = find_test_files(path)
+    pass_key = get_pass_key(test_path, expected_path)
+
+    if is_unchanged(path, pass_key):
+        return (1, 1, f"SUCCESS: {path}\n" if print_success else "",
+                {path: pass_key})
+
+    cache_path = get_cache_path(test_path, _worker_options["toki_hash"])
+    stdout = read_cache(cache_path)
+    if stdout is None:
+        ok, stdout = execute_test(path, test_path)
+        if not ok:
+            return (0, 1, stdout, {path: None})
+        write_cache(cache_path, stdout)
+
+    s, t, log = check_output(path, expected_path, stdout, print_success)
+    return (s, t, log, {path: pass_key if s else None})
+
+
+def check_cached(
+        paths: "list[str]"
+        ) -> "tuple[int, int, str, dict[str, Any], list[tuple]]":
+    """
+    Checks every test in `paths` that is unchanged or whose output is already
+    cached, returning the results like `run_one_test` does, along with the
+    path, test file, expected output file, cache path, and pass key of each
+    test still left to run.
+    """
+    print_success = _worker_options["print_success"]
+    successes = 0
+    trials = 0
+    log = ""
+    updates = {}
+    pending = []
+
+    for path in paths:
+        test_path, expected_path = find_test_files(path)
+        pass_key = get_pass_key(test_path, expected_path)
+
+        if is_unchanged(path, pass_key):
+            successes += 1
+            trials += 1
+            log += f"SUCCESS: {path}\n" if print_success else ""
+            updates[path] = pass_key
+            continue
+
+        cache_path = get_cache_path(test_path, _worker_options["toki_hash"])
+        stdout = read_cache(cache_path)
+        if stdout is not None:
+            s, t, l = check_output(path, expected_path, stdout, print_success)
+            successes += s
+            trials += t
+            log += l
+            updates[path] = pass_key if s else None
+        else:
+            # Until it runs and passes
+            updates[path] = None
+            pending.append((path, test_path, expected_path, cache_path,
+                            pass_key))
+
+    return successes, trials, log, updates, pending
+
+
+def run_batch(paths: "list[str]") -> "tuple[int, int, str, dict[str, Any]]":
+    """
+    Like `run_one_test`, but compiles every uncached test in `paths` with a
+    single `toki.exe --batch` invocation, so `toki.exe` only starts once.
+    """
+    print_success = _worker_options["print_success"]
+    successes, trials, log, updates, pending = check_cached(paths)
+    if not pending:
+        return successes, trials, log, updates
+
+    batch_stem = f"a_batch_{os.getpid()}"
+    manifest_path = f"{batch_stem}.txt"
+
+    # The artifact stem of every test `toki.exe` got to, and the error for
+    # any test it failed on
+    artifact_stems = {}
+    compile_errors = {}
+    processes = {}
+    # Each test's result, joined in test order once they're all in
+    logs = [""] * len(pending)
+
+    try:
+        # `toki.exe` stops at the first test that fails to compile, so each
+        # round starts a fresh `--batch` on the tests after the one that failed
+        start = 0
+        while start < len(pending):
+            round_stem = f"{batch_stem}_{len(compile_errors)}"
+            with open(manifest_path, "w") as mf:
+                for _, test_path, _, _, _ in pending[start:]:
+                    mf.write(test_path + "\n")
+
+            argv = ["./toki.exe", "--batch", manifest_path, round_stem]
+            result = subprocess.run(argv, stdout=subprocess.PIPE)
+
+            # `toki.exe` prints a line for each test it finished compiling
+            compiled = len(result.stdout.splitlines())
+            for j in range(compiled + 1):
+                if start + j < len(pending):
+                    artifact_stems[start + j] = f"{round_stem}_{j}"
+
+            if result.returncode == 0:
+                break
+            compile_errors[start + compiled] = subprocess.CalledProcessError(
+                result.returncode, argv)
+            start += compiled + 1
+
+        def collect(i: int):
+            nonlocal successes
+            path, _, expected_path, cache_path, pass_key = pending[i]
+            stdout, _ = processes.pop(i).communicate()
+            stdout = normalize_newlines(stdout)
+            write_cache(cache_path, stdout)
+
+            s, _, l = check_output(path, expected_path, stdout, print_success)
+            successes += s
+            logs[i] = l
+            if s:
+                updates[path] = pass_key
+
+        # Start executables before waiting on earlier ones, so their runtimes
+        # overlap instead of adding up, but only `max_inflight` at a time so
+        # a big batch can't run out of processes or pipes
+        for i, (path, _, _, _, _) in enumerate(pending):
+            artifact_stem = artifact_stems[i]
+            trials += 1
+
+            if i in compile_errors:
+                logs[i] = format_error(path, "Compilation error",
+                                       compile_errors[i])
+                continue
+            if not os.path.exists(f"./{artifact_stem}.exe"):
+                logs[i] = (f"FAILURE: {path}\n"
+                           f"  Compilation error (`{artifact_stem}.exe` "
+                           "not found)\n")
+                continue
+
+            if len(processes) >= _worker_options["max_inflight"]:
+                collect(next(iter(processes)))
+            processes[i] = subprocess.Popen([f"./{artifact_stem}.exe"],
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.PIPE)
+
+        while processes:
+            collect(next(iter(processes)))
+    finally:
+        # Only left over if something raised
+        for process in processes.values():
+            process.kill()
+            process.communicate()
+        _rm(manifest_path)
+        for artifact_stem in artifact_stems.values():
+            remove_artifacts(artifact_stem)
+
+    log += "".join(logs)
+    return successes, trials, log, updates
+
+
+def run_harness(paths: "list[str]") -> "tuple[int, int, str, dict[str, Any]]":
+    """
+    Like `run_batch`, but hands every uncached test in `paths` to a single
+    `toki.exe --harness` process, which compiles and runs each test and sends
+    back its output. No process is started here per test, only a pipe round
+    trip.
+    """
+    print_success = _worker_options["print_success"]
+    successes, trials, log, updates, pending = check_cached(paths)
+    if not pending:
+        return successes, trials, log, updates
+
+    harness_stem = f"a_harness_{os.getpid()}"
+    harness = None
+    artifact_stems = []
+    trials += len(pending)
+
+    try:
+        for i, (path, test_path, expected_path, cache_path, pass_key) in \
+                enumerate(pending):
+            if harness is None:
+                # The nth test sent to a harness is built as `<round stem>_n`
+                round_stem = f"{harness_stem}_{i}"
+                round_start = i
+                harness = subprocess.Popen(
+                    ["./toki.exe", "--harness", round_stem],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE)
+
+            artifact_stem = f"{round_stem}_{i - round_start}"
+            artifact_stems.append(artifact_stem)
+            harness.stdin.write(os.fsencode(test_path) + b"\n")
+            harness.stdin.flush()
+
+            header = harness.stdout.readline()
+            if not header:
+                # `toki.exe` exits on a test that fails to compile, so the
+                # tests after it get a new harness
+                returncode = harness.wait()
+                harness = None
+                log += (f"FAILURE: {path}\n"
+                        f"  Compilation error (code: {returncode})\n")
+                continue
+
+            length = int(header)
+            if length < 0:
+                log += (f"FAILURE: {path}\n"
+                        f"  Compilation error (`{artifact_stem}.exe` "
+                        "not found)\n")
+                continue
+
+            stdout = normalize_newlines(harness.stdout.read(length))
+            write_cache(cache_path, stdout)
+
+            s, _, l = check_output(path, expected_path, stdout, print_success)
+            successes += s
+            log += l
+            if s:
+                updates[path] = pass_key
+    finally:
+        if harness is not None:
+            # Closing stdin is what tells the harness to stop
+            harness.communicate()
+        for artifact_stem in artifact_stems:
+            remove_artifacts(artifact_stem)
+
+    return successes, trials, log, updates
+
+
+def load_last_pass() -> "dict[str, list[float]]":
+    try:
+        with open(LAST_PASS_PATH) as lf:
+            return json.load(lf)
+    except FileNotFoundError:
+        return {}
 
 
 def main():
@@ -181,10 +617,67 @@ def main():
     trials = 0
 
     if flags["endtoend"]:
-        for p in flags["endtoend"]:
-            s, t = test_end_to_end(p, flags["showsuccess"])
-            successes += s
-            trials += t
+        if flags["cache"]:
+            os.makedirs(CACHE_PATH, exist_ok=True)
+            with open("./toki.exe", "rb") as tf:
+                toki_hash = hashlib.sha256(tf.read()).digest()
+            last_pass = load_last_pass()
+        else:
+            toki_hash = None
+            last_pass = {}
+
+        options = {"print_success": flags["showsuccess"],
+                   "toki_hash": toki_hash,
+                   "toki_mtime": os.path.getmtime("./toki.exe"),
+                   "last_pass": last_pass.copy(),
+                   # How many test executables each batch worker runs at
+                   # once, shared out so all the workers together run about
+                   # two per CPU
+                   "max_inflight": max(1, 2 * (os.cpu_count() or 1)
+                                          // flags["jobs"])}
+
+        # Walked lazily, so workers start on the first tests before the walk
+        # has finished
+        leaves = (leaf for p in flags["endtoend"]
+                       for leaf in iter_leaf_tests(p))
+
+        # Each worker compiles and runs its own test, so one worker's compile
+        # overlaps with another's run
+        with ProcessPoolExecutor(flags["jobs"], initializer=init_worker,
+                                 initargs=(options,)) as executor:
+            if flags["harness"] or flags["batch_size"] > 1:
+                size = flags["batch_size"]
+                if flags["harness"] and size == 1:
+                    # Spread the tests evenly over one harness per job. That
+                    # needs the total, so this is the one mode where the walk
+                    # finishes before any test starts.
+                    leaves = list(leaves)
+                    size = max(1, -(-len(leaves) // flags["jobs"]))
+                runner = run_harness if flags["harness"] else run_batch
+                tasks = iter_batches(leaves, size)
+            else:
+                runner = run_one_test
+                tasks = leaves
+
+            # One task per submit, so a few slow tests can't hold up a whole
+            # chunk of fast ones behind them; idle workers just take the next
+            futures = [executor.submit(runner, task) for task in tasks]
+
+            # Results come back in the order they finish
+            for future in as_completed(futures):
+                s, t, log, updates = future.result()
+                successes += s
+                trials += t
+                sys.stdout.write(log)
+                for leaf, pass_key in updates.items():
+                    if pass_key is None:
+                        last_pass.pop(leaf, None)
+                    else:
+                        last_pass[leaf] = pass_key
+
+        if flags["cache"]:
+            with open(LAST_PASS_PATH, "w") as lf:
+                json.dump(last_pass, lf)
 
     print(f"TESTS FINISHED: {successes}/{trials} tests succeeded")
 
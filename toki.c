@@ -9,6 +9,20 @@
 #include <stdlib.h>
 #include <string.h>
 
+#ifdef _WIN32
+#include <fcntl.h>
+#include <io.h>
+#define popen _popen
+#define pclose _pclose
+#define POPEN_READ "rb"
+#define EXECUTABLE_FORMAT "%s.exe"
+#define NULL_DEVICE "NUL"
+#else
+#define POPEN_READ "r"
+#define EXECUTABLE_FORMAT "./%s.exe"
+#define NULL_DEVICE "/dev/null"
+#endif
+
 // FLAG DEFINITIONS
 
 /* Gives default arguments, if not provided. Useful for debugging.
@@ -22,6 +36,11 @@
  */
 #define DELETE_INTERMEDIATE 0
 
+/* The longest line (i.e. file path) read from a `--batch` manifest or by
+ * `--harness`.
+ */
+#define MAX_MANIFEST_LINE 1024
+
 // GRAMMAR DEFINITIONS
 
 /* Lexemes are raw strings which match a Token's pattern that have yet to be
@@ -1033,8 +1052,10 @@ void make(const char *outfile)
 {
     char *cmd1 = malloc(80 * sizeof(const char));
     char *cmd2 = malloc(80 * sizeof(const char));
-    sprintf(cmd1, "nasm -f win32 %s.asm", outfile);
-    sprintf(cmd2, "gcc %s.obj -o %s", outfile, outfile);
+    // `toki`'s own stdout is reserved for `--batch` and `--harness` output,
+    // so anything the tools print goes to stderr instead
+    sprintf(cmd1, "nasm -f win32 %s.asm 1>&2", outfile);
+    sprintf(cmd2, "gcc %s.obj -o %s 1>&2", outfile, outfile);
     system(cmd1);
     system(cmd2);
     free(cmd1);
@@ -1079,38 +1100,11 @@ void compile(const char *outfile, SentenceList input)
 
 // MAIN
 
-int main(int argc, const char *argv[])
+/* Reads, scans, evaluates, parses, and compiles the file `fname` into
+ * `outfname`.exe.
+ */
+void compile_file(const char *fname, const char *outfname)
 {
-    const char *fname;
-    const char *outfname;
-
-    // check number of arguments
-    if (argc == 3)
-    {
-        fname = argv[1];
-        outfname = argv[2];
-    } 
-    else if (argc == 2)
-    {
-        fname = argv[1];
-        outfname = DEFAULT_OUTPUT_FILENAME;
-    }
-    else if (argc == 1)
-    {
-        fname = DEFAULT_INPUT_FILENAME;
-        outfname = DEFAULT_OUTPUT_FILENAME;
-    }
-    else
-    {
-        fprintf(
-            stderr,
-            "Incorrect number of arguments (expected 0, 1, or 2, got %d)."
-            "Setting arguments to defaults and continuing\n",
-            argc - 1);
-        fname = DEFAULT_INPUT_FILENAME;
-        outfname = DEFAULT_OUTPUT_FILENAME;
-    }
-
     // open file
     FILE *fptr = fopen(fname, "rb");
 
@@ -1153,6 +1147,207 @@ int main(int argc, const char *argv[])
     compile(outfname, sentences);
 
     fclose(fptr);
+}
+
+/* Reads the next line of a manifest into `line` (which holds
+ * `MAX_MANIFEST_LINE` characters) without its newline. Returns false once
+ * there are no lines left, and exits if a line is too long, since splitting it
+ * would shift every later file onto the wrong output name.
+ */
+bool read_manifest_line(char *line, FILE *fptr)
+{
+    if (fgets(line, MAX_MANIFEST_LINE, fptr) == NULL)
+    {
+        return false;
+    }
+
+    if (strchr(line, '\n') == NULL)
+    {
+        // either the last line, or the line was cut off
+        int next = fgetc(fptr);
+        if (next != EOF && next != '\n')
+        {
+            fprintf(
+                stderr,
+                "Manifest line longer than %d characters.\n",
+                MAX_MANIFEST_LINE - 2);
+
+            exit(-1);
+        }
+    }
+
+    line[strcspn(line, "\r\n")] = '\0';
+    return true;
+}
+
+/* Compiles every file listed (one per line) in `manifest`, so that many files
+ * can be compiled without starting a new process for each. The nth file is
+ * written to `outprefix`_n.exe, counting from 0, and n is printed on its own
+ * line once it's done. Since a compilation error exits, the number of lines
+ * printed tells the caller which file failed.
+ */
+void compile_batch(const char *manifest, const char *outprefix)
+{
+    FILE *fptr = fopen(manifest, "r");
+
+    if (fptr == NULL)
+    {
+        fprintf(
+            stderr,
+            "Manifest \"%s\" not found.\n"
+            "  %s",
+            manifest, strerror(errno));
+
+        exit(-1);
+    }
+
+    char line[MAX_MANIFEST_LINE];
+    char *outfname = malloc((strlen(outprefix) + 16) * sizeof(char));
+
+    for (int i = 0; read_manifest_line(line, fptr); ++i)
+    {
+        sprintf(outfname, "%s_%d", outprefix, i);
+        compile_file(line, outfname);
+        printf("%d\n", i);
+        fflush(stdout);
+    }
+
+    free(outfname);
+    fclose(fptr);
+}
+
+/* Runs `exename` and returns everything it wrote to stdout, with the length
+ * in `length`. Its stderr is thrown away, the same as when the tests run the
+ * executable themselves.
+ */
+char *run_capture(const char *exename, size_t *length)
+{
+    char *cmd = malloc((strlen(exename) + 16) * sizeof(char));
+    sprintf(cmd, "%s 2>" NULL_DEVICE, exename);
+
+    FILE *pptr = popen(cmd, POPEN_READ);
+    free(cmd);
+
+    if (pptr == NULL)
+    {
+        fprintf(
+            stderr,
+            "Failed to run \"%s\".\n"
+            "  %s",
+            exename, strerror(errno));
+
+        exit(-1);
+    }
+
+    size_t capacity = 1024;
+    char *output = malloc(capacity * sizeof(char));
+    *length = 0;
+
+    size_t n;
+    while ((n = fread(output + *length, 1, capacity - *length, pptr)) > 0)
+    {
+        *length += n;
+        if (*length == capacity)
+        {
+            capacity *= 2;
+            output = realloc(output, capacity * sizeof(char));
+        }
+    }
+
+    pclose(pptr);
+    return output;
+}
+
+/* Keeps running as a test harness: reads one file path per line from stdin,
+ * compiles the nth file to `outprefix`_n.exe, runs it, and writes its output
+ * to stdout as "<length>\n<output>". A length of -1 means the file compiled
+ * but no executable was made. This saves starting `toki` again for every test.
+ */
+void run_harness(const char *outprefix)
+{
+#ifdef _WIN32
+    // the output is passed through byte for byte
+    _setmode(_fileno(stdout), _O_BINARY);
+#endif
+
+    char line[MAX_MANIFEST_LINE];
+    char *outfname = malloc((strlen(outprefix) + 16) * sizeof(char));
+    char *exename = malloc((strlen(outprefix) + 20) * sizeof(char));
+
+    for (int i = 0; read_manifest_line(line, stdin); ++i)
+    {
+        sprintf(outfname, "%s_%d", outprefix, i);
+        sprintf(exename, EXECUTABLE_FORMAT, outfname);
+        compile_file(line, outfname);
+
+        FILE *eptr = fopen(exename, "rb");
+        if (eptr == NULL)
+        {
+            printf("-1\n");
+            fflush(stdout);
+            continue;
+        }
+        fclose(eptr);
+
+        size_t length;
+        char *output = run_capture(exename, &length);
+        printf("%zu\n", length);
+        fwrite(output, 1, length, stdout);
+        fflush(stdout);
+        free(output);
+    }
+
+    free(outfname);
+    free(exename);
+}
+
+int main(int argc, const char *argv[])
+{
+    const char *fname;
+    const char *outfname;
+
+    // check for batch mode
+    if (argc == 4 && strcmp(argv[1], "--batch") == 0)
+    {
+        compile_batch(argv[2], argv[3]);
+        exit(0);
+    }
+
+    // check for harness mode
+    if (argc == 3 && strcmp(argv[1], "--harness") == 0)
+    {
+        run_harness(argv[2]);
+        exit(0);
+    }
+
+    // check number of arguments
+    if (argc == 3)
+    {
+        fname = argv[1];
+        outfname = argv[2];
+    } 
+    else if (argc == 2)
+    {
+        fname = argv[1];
+        outfname = DEFAULT_OUTPUT_FILENAME;
+    }
+    else if (argc == 1)
+    {
+        fname = DEFAULT_INPUT_FILENAME;
+        outfname = DEFAULT_OUTPUT_FILENAME;
+    }
+    else
+    {
+        fprintf(
+            stderr,
+            "Incorrect number of arguments (expected 0, 1, or 2, got %d)."
+            "Setting arguments to defaults and continuing\n",
+            argc - 1);
+        fname = DEFAULT_INPUT_FILENAME;
+        outfname = DEFAULT_OUTPUT_FILENAME;
+    }
+
+    compile_file(fname, outfname);
 
     exit(0);
 }